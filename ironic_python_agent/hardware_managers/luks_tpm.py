@@ -0,0 +1,386 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from concurrent import futures
+import functools
+import json
+import os
+
+from oslo_concurrency import processutils
+from oslo_log import log
+from oslo_utils import excutils
+
+from ironic_python_agent import disk_utils
+from ironic_python_agent import errors
+from ironic_python_agent import hardware
+from ironic_python_agent import luks_utils
+from ironic_python_agent import tpm_utils as tpm
+from ironic_python_agent import utils
+
+LOG = log.getLogger()
+
+# GPT type code of the x86-64 root partition, per the Discoverable
+# Partitions Specification.
+ROOT_PARTITION_TYPECODE = '4F68BCE3-E8CD-4DB1-96E7-FBCAF984B709'
+# GPT partition label used for the config drive partition.
+CONFIG_DRIVE_PARTLABEL = 'config-2'
+# Device mapper target name for the opened config drive.
+CONFIG_DRIVE_MAP_TARGET = 'config-2'
+# Symlink recording the detected root partition for later deploy steps.
+ROOT_PARTITION_LINK = '/tmp/root_partition'
+
+
+@functools.lru_cache(maxsize=1)
+def _detect_dependency():
+    """Check that both LUKS and TPM support is present on the ramdisk.
+
+    The TPM is fixed to the motherboard and the ramdisk tooling cannot
+    change while the agent runs, so the probe result is cached for the
+    lifetime of the process; evaluate_hardware_support is invoked
+    repeatedly across the hardware managers.
+    """
+    luks_ok = luks_utils.check_luks_compatibility()
+    tpm_ok = tpm.check_tpm_compatibility()
+    return luks_ok and tpm_ok
+
+
+@functools.lru_cache()
+def _sector_size(device):
+    """Return the cached logical sector size of a device.
+
+    The sector size of a device cannot change while the agent runs, so
+    it is only queried once per device instead of shelling out on every
+    call in the encryption flow.
+    """
+    return disk_utils.get_dev_sector_size(device)
+
+
+@functools.lru_cache(maxsize=1)
+def _has_aesni():
+    """Check /proc/cpuinfo for hardware AES support.
+
+    Matches the 'aes' feature both in the x86 flags line and in the ARM
+    Features line. Without it, AES runs in software at orders of
+    magnitude below AES-NI throughput and a root re-encryption stalls
+    the deploy for minutes.
+    """
+    try:
+        with open('/proc/cpuinfo') as cpuinfo:
+            for line in cpuinfo:
+                if (line.startswith(('flags', 'Features'))
+                        and 'aes' in line.split()):
+                    return True
+    except OSError as e:
+        LOG.warning('Unable to read /proc/cpuinfo: %s', e)
+    return False
+
+
+def invalidate_caches():
+    """Drop cached probe state, e.g. after a ramdisk reinit."""
+    _detect_dependency.cache_clear()
+    _has_aesni.cache_clear()
+    _get_partition_parent_device_name.cache_clear()
+    _sector_size.cache_clear()
+
+
+@functools.lru_cache(maxsize=64)
+def _get_partition_parent_device_name(path_to_partition):
+    """Return the name of the disk holding a partition."""
+    parent_device, _e = utils.execute('lsblk', '-no', 'PKNAME',
+                                      path_to_partition)
+    return parent_device.strip()
+
+
+def _get_partition_table(device):
+    """Read the partition table of a disk in a single sfdisk call.
+
+    Parsing the machine readable JSON report avoids both the ad-hoc
+    text parsing of the human oriented sgdisk output and its locale
+    dependent formatting.
+
+    :param device: path to the disk.
+    :returns: dict with the last usable sector of the disk and a list
+        of partition dicts holding the partition number, first and last
+        sector and the GPT type GUID.
+    :raises: ProcessExecutionError on failure.
+    """
+    report, _e = utils.execute('sfdisk', '--json', device)
+    table = json.loads(report)['partitiontable']
+    part_table = {'last_usable_sector': table['lastlba'], 'partitions': []}
+    for part in table['partitions']:
+        part_table['partitions'].append({
+            'number': int(part['node'].replace(device, '').lstrip('p')),
+            'first_sector': part['start'],
+            'last_sector': part['start'] + part['size'] - 1,
+            'type': part['type'],
+        })
+    return part_table
+
+
+def _grow_part(device, idx_num, part_table=None):
+    """Grow a partition to make room for the LUKS2 header.
+
+    cryptsetup reencrypt shrinks the usable device by the header size,
+    so the partition is first extended by the same amount to keep the
+    file system inside it intact.
+
+    :param device: path to the disk holding the partition.
+    :param idx_num: index of the partition in the partition table.
+    :param part_table: an already parsed partition table of the device,
+        to avoid rescanning it.
+    :raises: DeviceNotFound if the partition does not exist.
+    :raises: ProcessExecutionError on failure.
+    """
+    if part_table is None:
+        part_table = _get_partition_table(device)
+    for part in part_table['partitions']:
+        if part['number'] == idx_num:
+            break
+    else:
+        raise errors.DeviceNotFound('Partition %s not found on device %s'
+                                    % (idx_num, device))
+    first_sector = part['first_sector']
+    last_sector = part['last_sector']
+    sector_size = _sector_size(device)
+    luks_header_sectors = int(luks_utils.LUKS_HEADER_SIZE / sector_size)
+    free_tail = part_table['last_usable_sector'] - last_sector
+    if free_tail >= luks_header_sectors:
+        # the disk was laid out with the LUKS header allowance in mind;
+        # skipping the resize avoids a partition table rewrite and the
+        # kernel reread plus udev settle storm that follows it
+        LOG.debug('Partition %(part)s on %(device)s has %(free)s sectors '
+                  'of tail free space, not resizing it',
+                  {'part': idx_num, 'device': device, 'free': free_tail})
+        return
+    LOG.debug('Growing partition %(part)s on %(device)s by %(sectors)s '
+              'sectors for the LUKS2 header',
+              {'part': idx_num, 'device': device,
+               'sectors': luks_header_sectors})
+    new_last_sector = int(last_sector) + luks_header_sectors
+    # NOTE: deriving the index from a partition path would need suffix
+    # handling for nvme/dm devices:
+    # part_suffix = partition.replace(device, '')
+    # idx_num = part_suffix.replace('-part', '').lstrip('p')
+    try:
+        utils.execute('sgdisk', '-e',
+                      '-d', str(idx_num),
+                      '-n', f'{idx_num}:{first_sector}:{new_last_sector}',
+                      device)
+        utils.execute('partprobe', device)
+        # the grown area may hold stale data that the reencrypt pass
+        # would otherwise dutifully encrypt; a discard is nearly free on
+        # SSDs and leaves deterministic zeroes behind
+        try:
+            utils.execute('blkdiscard',
+                          '--offset', str((last_sector + 1) * sector_size),
+                          '--length', str(luks_utils.LUKS_HEADER_SIZE),
+                          device)
+        except (processutils.ProcessExecutionError, OSError) as e:
+            LOG.debug('Discarding the grown area on %(device)s failed, '
+                      'continuing without it: %(error)s',
+                      {'device': device, 'error': e})
+    except processutils.ProcessExecutionError as e:
+        with excutils.save_and_reraise_exception():
+            LOG.error('Failed to grow partition %(part)s on %(device)s to '
+                      'sector %(last)s, error: %(error)s',
+                      {'part': idx_num, 'device': device,
+                       'last': new_last_sector, 'error': e})
+
+
+def detect_root_partition_on_device(device, part_table=None):
+    """Detect the root partition on a disk by its GPT type code.
+
+    Scans the partition table of the device for a partition whose type
+    matches the discoverable root partition type and records the result
+    under /tmp/root_partition for later deploy steps.
+
+    :param device: path to the disk holding the root partition.
+    :param part_table: an already parsed partition table of the device,
+        to avoid rescanning it.
+    :returns: dict with the partition number and path.
+    :raises: DeviceNotFound if the disk has no root partition.
+    """
+    if part_table is None:
+        part_table = _get_partition_table(device)
+    for part in part_table['partitions']:
+        if part['type'].upper() == ROOT_PARTITION_TYPECODE:
+            partition_path = disk_utils.partition_index_to_path(
+                device, part['number'])
+            root_partition_info = {
+                'partition_number': part['number'],
+                'partition_path': partition_path,
+            }
+            # a symlink(2) does not need a forked 'ln' for this
+            if os.path.islink(ROOT_PARTITION_LINK):
+                os.unlink(ROOT_PARTITION_LINK)
+            os.symlink(partition_path, ROOT_PARTITION_LINK)
+            return root_partition_info
+    raise errors.DeviceNotFound('No root partition found on device %s'
+                                % device)
+
+
+def _encrypt_partitions_parallel(jobs):
+    """Encrypt several independent partitions concurrently.
+
+    Each re-encryption blocks on a subprocess that is I/O bound on its
+    own device, so running the jobs in threads brings the wall clock
+    time for a multi-partition node from the sum of the individual runs
+    down to roughly the longest one.
+
+    :param jobs: list of (key_bytes, partition) tuples, one per
+        partition to encrypt.
+    :raises: the first exception raised by any of the jobs.
+    """
+    if not jobs:
+        return
+    with futures.ThreadPoolExecutor(max_workers=len(jobs)) as executor:
+        tasks = [executor.submit(luks_utils.luks_re_encrypt_partition,
+                                 key, partition)
+                 for key, partition in jobs]
+        for task in tasks:
+            try:
+                task.result()
+            except Exception:
+                with excutils.save_and_reraise_exception():
+                    LOG.error('Parallel partition encryption failed')
+
+
+def _get_config_drive_partition(device):
+    """Find the config drive partition on a disk by partition label.
+
+    :param device: path to the disk holding the config drive.
+    :returns: path to the config drive partition.
+    :raises: DeviceNotFound if the disk has no config drive partition.
+    """
+    report, _e = utils.execute('lsblk', '-Ppo', 'NAME,PARTLABEL', device)
+    for line in report.splitlines():
+        if 'PARTLABEL="%s"' % CONFIG_DRIVE_PARTLABEL in line:
+            return line.split()[0].partition('=')[2].strip('"')
+    raise errors.DeviceNotFound('No config drive partition found on '
+                                'device %s' % device)
+
+
+class LuksTpmHardwareManager(hardware.HardwareManager):
+    """Hardware manager encrypting partitions with a TPM backed LUKS key."""
+
+    HARDWARE_MANAGER_NAME = 'LuksTpmHardwareManager'
+    HARDWARE_MANAGER_VERSION = '1'
+
+    def __init__(self):
+        self._cached_key = None
+
+    def _get_key(self):
+        """Return the LUKS key, unsealing it from the TPM only once.
+
+        Every unseal is a round-trip to the TPM chip, so the key is
+        cached on the manager for the deploy steps that follow; it is
+        stable for the session as the sealing hierarchy does not change
+        across a boot. The last step using the key drops the cache via
+        _cleanup_key.
+
+        :returns: the key as bytes.
+        :raises: ProcessExecutionError on failure to talk to the TPM.
+        """
+        if self._cached_key is None:
+            self._cached_key = tpm.check_and_generate_key_file()
+        return self._cached_key
+
+    def _cleanup_key(self):
+        """Zeroize and drop the cached LUKS key."""
+        if self._cached_key is not None:
+            tpm.zeroize_key(self._cached_key)
+            self._cached_key = None
+
+    def evaluate_hardware_support(self):
+        """Declare level of hardware support provided."""
+        if not _has_aesni():
+            LOG.debug('CPU has no hardware AES support, encryption would '
+                      'be unusably slow')
+            return hardware.HardwareSupport.NONE
+        if _detect_dependency():
+            LOG.debug('Found LUKS and TPM support')
+            return hardware.HardwareSupport.MAINLINE
+        else:
+            LOG.debug('LUKS or TPM support not found')
+            return hardware.HardwareSupport.NONE
+
+    def get_deploy_steps(self, node, ports):
+        """Get a list of deploy steps with priority.
+
+        :param node: The node object as provided by Ironic.
+        :param ports: Port objects as provided by Ironic.
+        :returns: A list of deploy steps, as a list of dicts.
+        """
+        return [
+            {
+                'step': 'whole_disk_image_encryption',
+                'priority': 0,
+                'interface': 'deploy',
+                'reboot_requested': False,
+                'argsinfo': {},
+            },
+            {
+                'step': 'config_drive_encryption',
+                'priority': 0,
+                'interface': 'deploy',
+                'reboot_requested': False,
+                'argsinfo': {},
+            },
+            {
+                'step': 'config_drive_open',
+                'priority': 0,
+                'interface': 'deploy',
+                'reboot_requested': False,
+                'argsinfo': {},
+            },
+        ]
+
+    def whole_disk_image_encryption(self, node, ports):
+        """Encrypt the root partition of a deployed whole disk image.
+
+        The root partition already holds the image content, so it is
+        grown by the LUKS2 header size and re-encrypted in place.
+        """
+        invalidate_caches()
+        device = hardware.dispatch_to_managers('get_os_install_device')
+        part_table = _get_partition_table(device)
+        root_partition_info = detect_root_partition_on_device(
+            device, part_table=part_table)
+        key = self._get_key()
+        _grow_part(device, root_partition_info['partition_number'],
+                   part_table=part_table)
+        # a single job today; root partitions of additional disks
+        # join this list once multi-disk support lands
+        _encrypt_partitions_parallel(
+            [(key, root_partition_info['partition_path'])])
+
+    def config_drive_encryption(self, node, ports):
+        """Create an encrypted config drive partition.
+
+        The config drive partition is always empty when this step runs;
+        it is opened and populated afterwards, so a plain luksFormat is
+        enough and no data pass is needed.
+        """
+        device = hardware.dispatch_to_managers('get_os_install_device')
+        partition = _get_config_drive_partition(device)
+        luks_utils.luks_format_partition(self._get_key(), partition)
+
+    def config_drive_open(self, node, ports):
+        """Open the encrypted config drive partition under /dev/mapper."""
+        device = hardware.dispatch_to_managers('get_os_install_device')
+        partition = _get_config_drive_partition(device)
+        try:
+            return luks_utils.luks_open_partition(self._get_key(), partition,
+                                                  CONFIG_DRIVE_MAP_TARGET)
+        finally:
+            # this is the last deploy step needing the key
+            self._cleanup_key()
@@ -0,0 +1,346 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+from unittest import mock
+
+from oslo_concurrency import processutils
+
+from ironic_python_agent import disk_utils
+from ironic_python_agent import errors
+from ironic_python_agent import hardware
+from ironic_python_agent.hardware_managers import luks_tpm
+from ironic_python_agent import luks_utils
+from ironic_python_agent.tests.unit import base
+from ironic_python_agent import tpm_utils as tpm
+from ironic_python_agent import utils
+
+SFDISK_JSON = """{
+   "partitiontable": {
+      "label": "gpt",
+      "id": "90A24B65-A239-4142-A6F2-E870A2BE2AA5",
+      "device": "/dev/sda",
+      "unit": "sectors",
+      "firstlba": 34,
+      "lastlba": 41943006,
+      "sectorsize": 512,
+      "partitions": [
+         {"node": "/dev/sda1", "start": 2048, "size": 204800,
+          "type": "C12A7328-F81F-11D2-BA4B-00A0C93EC93B",
+          "uuid": "62DAAFFF-B371-4021-A95C-E86F7AD70F12",
+          "name": "EFI system"},
+         {"node": "/dev/sda2", "start": 206848, "size": 20764672,
+          "type": "4F68BCE3-E8CD-4DB1-96E7-FBCAF984B709",
+          "uuid": "874D34BB-EA5B-4E58-9A27-54CBAF2EF1C6",
+          "name": "root"}
+      ]
+   }
+}
+"""
+
+LSBLK_PAIRS = """NAME="/dev/sda" PARTLABEL=""
+NAME="/dev/sda1" PARTLABEL=""
+NAME="/dev/sda2" PARTLABEL="config-2"
+"""
+
+
+class TestModuleFunctions(base.IronicAgentTest):
+
+    def setUp(self):
+        super(TestModuleFunctions, self).setUp()
+        luks_tpm.invalidate_caches()
+
+    @mock.patch.object(disk_utils, 'get_dev_sector_size', autospec=True)
+    def test_sector_size_cached(self, mock_sector_size):
+        mock_sector_size.return_value = 512
+        self.assertEqual(512, luks_tpm._sector_size('/dev/sda'))
+        self.assertEqual(512, luks_tpm._sector_size('/dev/sda'))
+        mock_sector_size.assert_called_once_with('/dev/sda')
+
+    @mock.patch.object(utils, 'execute', autospec=True)
+    def test_get_partition_parent_device_name(self, mock_execute):
+        mock_execute.return_value = ('sda\n', '')
+        self.assertEqual(
+            'sda', luks_tpm._get_partition_parent_device_name('/dev/sda2'))
+        # the result is memoized, lsblk only runs once per partition
+        self.assertEqual(
+            'sda', luks_tpm._get_partition_parent_device_name('/dev/sda2'))
+        mock_execute.assert_called_once_with('lsblk', '-no', 'PKNAME',
+                                             '/dev/sda2')
+
+    @mock.patch.object(utils, 'execute', autospec=True)
+    def test_get_partition_table(self, mock_execute):
+        mock_execute.return_value = (SFDISK_JSON, '')
+        result = luks_tpm._get_partition_table('/dev/sda')
+        self.assertEqual(41943006, result['last_usable_sector'])
+        self.assertEqual([
+            {'number': 1, 'first_sector': 2048, 'last_sector': 206847,
+             'type': 'C12A7328-F81F-11D2-BA4B-00A0C93EC93B'},
+            {'number': 2, 'first_sector': 206848, 'last_sector': 20971519,
+             'type': '4F68BCE3-E8CD-4DB1-96E7-FBCAF984B709'},
+        ], result['partitions'])
+        mock_execute.assert_called_once_with('sfdisk', '--json', '/dev/sda')
+
+    @mock.patch.object(os, 'symlink', autospec=True)
+    @mock.patch.object(os.path, 'islink', autospec=True, return_value=False)
+    @mock.patch.object(utils, 'execute', autospec=True)
+    def test_detect_root_partition_on_device(self, mock_execute, mock_islink,
+                                             mock_symlink):
+        mock_execute.return_value = (SFDISK_JSON, '')
+        result = luks_tpm.detect_root_partition_on_device('/dev/sda')
+        self.assertEqual({'partition_number': 2,
+                          'partition_path': '/dev/sda2'}, result)
+        mock_execute.assert_called_once_with('sfdisk', '--json', '/dev/sda')
+        mock_symlink.assert_called_once_with('/dev/sda2',
+                                             '/tmp/root_partition')
+
+    @mock.patch.object(os, 'unlink', autospec=True)
+    @mock.patch.object(os, 'symlink', autospec=True)
+    @mock.patch.object(os.path, 'islink', autospec=True, return_value=True)
+    @mock.patch.object(utils, 'execute', autospec=True)
+    def test_detect_root_partition_on_device_stale_link(self, mock_execute,
+                                                        mock_islink,
+                                                        mock_symlink,
+                                                        mock_unlink):
+        mock_execute.return_value = (SFDISK_JSON, '')
+        luks_tpm.detect_root_partition_on_device('/dev/sda')
+        mock_unlink.assert_called_once_with('/tmp/root_partition')
+        mock_symlink.assert_called_once_with('/dev/sda2',
+                                             '/tmp/root_partition')
+
+    @mock.patch.object(utils, 'execute', autospec=True)
+    def test_detect_root_partition_on_device_not_found(self, mock_execute):
+        mock_execute.return_value = (
+            SFDISK_JSON.replace('4F68BCE3-E8CD-4DB1-96E7-FBCAF984B709',
+                                '0FC63DAF-8483-4772-8E79-3D69D8477DE4'), '')
+        self.assertRaises(errors.DeviceNotFound,
+                          luks_tpm.detect_root_partition_on_device,
+                          '/dev/sda')
+
+    @mock.patch.object(disk_utils, 'get_dev_sector_size', autospec=True)
+    @mock.patch.object(utils, 'execute', autospec=True)
+    def test_grow_part(self, mock_execute, mock_sector_size):
+        # the root partition ends 1000 sectors before the end of the disk
+        mock_execute.return_value = (
+            SFDISK_JSON.replace('"size": 20764672', '"size": 41735159'), '')
+        mock_sector_size.return_value = 512
+        luks_tpm._grow_part('/dev/sda', 2)
+        # 32 MiB of 512 byte sectors on top of the current last sector
+        mock_execute.assert_has_calls([
+            mock.call('sfdisk', '--json', '/dev/sda'),
+            mock.call('sgdisk', '-e', '-d', '2',
+                      '-n', '2:206848:42007542', '/dev/sda'),
+            mock.call('partprobe', '/dev/sda'),
+            mock.call('blkdiscard', '--offset', '21474307584',
+                      '--length', '33554432', '/dev/sda'),
+        ])
+
+    @mock.patch.object(disk_utils, 'get_dev_sector_size', autospec=True)
+    @mock.patch.object(utils, 'execute', autospec=True)
+    def test_grow_part_discard_failure_ignored(self, mock_execute,
+                                               mock_sector_size):
+        sfdisk_json = SFDISK_JSON.replace('"size": 20764672',
+                                          '"size": 41735159')
+
+        def fake_execute(*args, **kwargs):
+            if args[0] == 'blkdiscard':
+                raise processutils.ProcessExecutionError('not supported')
+            return (sfdisk_json, '')
+
+        mock_execute.side_effect = fake_execute
+        mock_sector_size.return_value = 512
+        luks_tpm._grow_part('/dev/sda', 2)
+
+    @mock.patch.object(disk_utils, 'get_dev_sector_size', autospec=True)
+    @mock.patch.object(utils, 'execute', autospec=True)
+    def test_grow_part_enough_tail_space(self, mock_execute,
+                                         mock_sector_size):
+        mock_execute.return_value = (SFDISK_JSON, '')
+        mock_sector_size.return_value = 512
+        luks_tpm._grow_part('/dev/sda', 2)
+        # well over 32 MiB of free space behind the partition, the
+        # partition table is left untouched
+        mock_execute.assert_called_once_with('sfdisk', '--json', '/dev/sda')
+
+    @mock.patch.object(disk_utils, 'get_dev_sector_size', autospec=True)
+    @mock.patch.object(utils, 'execute', autospec=True)
+    def test_grow_part_missing_partition(self, mock_execute,
+                                         mock_sector_size):
+        mock_execute.return_value = (SFDISK_JSON, '')
+        self.assertRaises(errors.DeviceNotFound,
+                          luks_tpm._grow_part, '/dev/sda', 3)
+
+    @mock.patch.object(luks_utils, 'luks_re_encrypt_partition', autospec=True)
+    def test_encrypt_partitions_parallel(self, mock_reencrypt):
+        luks_tpm._encrypt_partitions_parallel([(b'key1', '/dev/sda2'),
+                                               (b'key2', '/dev/sdb2')])
+        mock_reencrypt.assert_has_calls([
+            mock.call(b'key1', '/dev/sda2'),
+            mock.call(b'key2', '/dev/sdb2'),
+        ], any_order=True)
+
+    @mock.patch.object(luks_utils, 'luks_re_encrypt_partition', autospec=True)
+    def test_encrypt_partitions_parallel_failure(self, mock_reencrypt):
+        mock_reencrypt.side_effect = [None, RuntimeError('boom')]
+        self.assertRaises(
+            RuntimeError, luks_tpm._encrypt_partitions_parallel,
+            [(b'key1', '/dev/sda2'), (b'key2', '/dev/sdb2')])
+
+    @mock.patch.object(utils, 'execute', autospec=True)
+    def test_get_config_drive_partition(self, mock_execute):
+        mock_execute.return_value = (LSBLK_PAIRS, '')
+        self.assertEqual(
+            '/dev/sda2', luks_tpm._get_config_drive_partition('/dev/sda'))
+        mock_execute.assert_called_once_with('lsblk', '-Ppo',
+                                             'NAME,PARTLABEL', '/dev/sda')
+
+    @mock.patch.object(utils, 'execute', autospec=True)
+    def test_get_config_drive_partition_not_found(self, mock_execute):
+        mock_execute.return_value = ('NAME="/dev/sda" PARTLABEL=""\n', '')
+        self.assertRaises(errors.DeviceNotFound,
+                          luks_tpm._get_config_drive_partition, '/dev/sda')
+
+
+class TestLuksTpmHardwareManager(base.IronicAgentTest):
+
+    def setUp(self):
+        super(TestLuksTpmHardwareManager, self).setUp()
+        luks_tpm.invalidate_caches()
+        self.hardware = luks_tpm.LuksTpmHardwareManager()
+        self.node = {'uuid': 'dda135fb-732d-4742-8e72-df8f3199d244',
+                     'driver_internal_info': {}}
+
+    @mock.patch.object(luks_tpm, '_has_aesni', autospec=True,
+                       return_value=True)
+    @mock.patch.object(tpm, 'check_tpm_compatibility', autospec=True)
+    @mock.patch.object(luks_utils, 'check_luks_compatibility', autospec=True)
+    def test_evaluate_hardware_support(self, mock_luks, mock_tpm,
+                                       mock_aesni):
+        mock_luks.return_value = True
+        mock_tpm.return_value = True
+        self.assertEqual(hardware.HardwareSupport.MAINLINE,
+                         self.hardware.evaluate_hardware_support())
+
+    @mock.patch.object(luks_tpm, '_has_aesni', autospec=True,
+                       return_value=False)
+    def test_evaluate_hardware_support_no_aesni(self, mock_aesni):
+        self.assertEqual(hardware.HardwareSupport.NONE,
+                         self.hardware.evaluate_hardware_support())
+
+    @mock.patch.object(luks_tpm, '_has_aesni', autospec=True,
+                       return_value=True)
+    @mock.patch.object(tpm, 'check_tpm_compatibility', autospec=True)
+    @mock.patch.object(luks_utils, 'check_luks_compatibility', autospec=True)
+    def test_evaluate_hardware_support_no_tpm(self, mock_luks, mock_tpm,
+                                              mock_aesni):
+        mock_luks.return_value = True
+        mock_tpm.return_value = False
+        self.assertEqual(hardware.HardwareSupport.NONE,
+                         self.hardware.evaluate_hardware_support())
+
+    @mock.patch.object(luks_tpm, '_has_aesni', autospec=True,
+                       return_value=True)
+    @mock.patch.object(tpm, 'check_tpm_compatibility', autospec=True)
+    @mock.patch.object(luks_utils, 'check_luks_compatibility', autospec=True)
+    def test_evaluate_hardware_support_cached(self, mock_luks, mock_tpm,
+                                              mock_aesni):
+        mock_luks.return_value = True
+        mock_tpm.return_value = True
+        self.hardware.evaluate_hardware_support()
+        self.hardware.evaluate_hardware_support()
+        mock_luks.assert_called_once_with()
+        mock_tpm.assert_called_once_with()
+
+    @mock.patch.object(tpm, 'check_and_generate_key_file', autospec=True)
+    def test_get_key_cached(self, mock_key):
+        mock_key.return_value = b'supersecret'
+        self.assertEqual(b'supersecret', self.hardware._get_key())
+        # the key is memoized, the TPM is only hit once per deploy
+        self.assertEqual(b'supersecret', self.hardware._get_key())
+        mock_key.assert_called_once_with()
+
+    @mock.patch.object(tpm, 'zeroize_key', autospec=True)
+    @mock.patch.object(tpm, 'check_and_generate_key_file', autospec=True)
+    def test_cleanup_key(self, mock_key, mock_zeroize):
+        mock_key.return_value = b'supersecret'
+        self.hardware._get_key()
+        self.hardware._cleanup_key()
+        mock_zeroize.assert_called_once_with(b'supersecret')
+        self.assertIsNone(self.hardware._cached_key)
+        # a second cleanup is a no-op
+        self.hardware._cleanup_key()
+        mock_zeroize.assert_called_once_with(b'supersecret')
+
+    @mock.patch.object(tpm, 'zeroize_key', autospec=True)
+    @mock.patch.object(luks_utils, 'luks_re_encrypt_partition', autospec=True)
+    @mock.patch.object(luks_tpm, '_grow_part', autospec=True)
+    @mock.patch.object(tpm, 'check_and_generate_key_file', autospec=True)
+    @mock.patch.object(luks_tpm, 'detect_root_partition_on_device',
+                       autospec=True)
+    @mock.patch.object(luks_tpm, '_get_partition_table', autospec=True)
+    @mock.patch.object(hardware, 'dispatch_to_managers', autospec=True)
+    def test_whole_disk_image_encryption(self, mock_dispatch, mock_table,
+                                         mock_detect, mock_key, mock_grow,
+                                         mock_reencrypt, mock_zeroize):
+        part_table = {'last_usable_sector': 41943006, 'partitions': []}
+        mock_dispatch.return_value = '/dev/sda'
+        mock_table.return_value = part_table
+        mock_detect.return_value = {'partition_number': 2,
+                                    'partition_path': '/dev/sda2'}
+        mock_key.return_value = b'supersecret'
+        self.hardware.whole_disk_image_encryption(self.node, [])
+        # the partition table is only scanned once for the whole step
+        mock_table.assert_called_once_with('/dev/sda')
+        mock_detect.assert_called_once_with('/dev/sda',
+                                            part_table=part_table)
+        mock_grow.assert_called_once_with('/dev/sda', 2,
+                                          part_table=part_table)
+        mock_reencrypt.assert_called_once_with(b'supersecret', '/dev/sda2')
+        # the key stays cached for the config drive steps
+        mock_zeroize.assert_not_called()
+        self.assertEqual(b'supersecret', self.hardware._cached_key)
+
+    @mock.patch.object(tpm, 'zeroize_key', autospec=True)
+    @mock.patch.object(luks_utils, 'luks_format_partition', autospec=True)
+    @mock.patch.object(tpm, 'check_and_generate_key_file', autospec=True)
+    @mock.patch.object(luks_tpm, '_get_config_drive_partition', autospec=True)
+    @mock.patch.object(hardware, 'dispatch_to_managers', autospec=True)
+    def test_config_drive_encryption(self, mock_dispatch, mock_partition,
+                                     mock_key, mock_format, mock_zeroize):
+        mock_dispatch.return_value = '/dev/sda'
+        mock_partition.return_value = '/dev/sda2'
+        mock_key.return_value = b'supersecret'
+        self.hardware.config_drive_encryption(self.node, [])
+        # the config drive partition is empty, no data pass is expected
+        mock_format.assert_called_once_with(b'supersecret', '/dev/sda2')
+        # the key stays cached for the config drive open step
+        mock_zeroize.assert_not_called()
+        self.assertEqual(b'supersecret', self.hardware._cached_key)
+
+    @mock.patch.object(tpm, 'zeroize_key', autospec=True)
+    @mock.patch.object(luks_utils, 'luks_open_partition', autospec=True)
+    @mock.patch.object(tpm, 'check_and_generate_key_file', autospec=True)
+    @mock.patch.object(luks_tpm, '_get_config_drive_partition', autospec=True)
+    @mock.patch.object(hardware, 'dispatch_to_managers', autospec=True)
+    def test_config_drive_open(self, mock_dispatch, mock_partition,
+                               mock_key, mock_open, mock_zeroize):
+        mock_dispatch.return_value = '/dev/sda'
+        mock_partition.return_value = '/dev/sda2'
+        mock_key.return_value = b'supersecret'
+        mock_open.return_value = '/dev/mapper/config-2'
+        result = self.hardware.config_drive_open(self.node, [])
+        self.assertEqual('/dev/mapper/config-2', result)
+        mock_open.assert_called_once_with(b'supersecret', '/dev/sda2',
+                                          'config-2')
+        # the last step using the key drops the cache
+        mock_zeroize.assert_called_once_with(b'supersecret')
+        self.assertIsNone(self.hardware._cached_key)
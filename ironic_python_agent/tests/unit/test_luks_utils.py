@@ -0,0 +1,105 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+from unittest import mock
+
+from oslo_concurrency import processutils
+
+from ironic_python_agent import disk_utils
+from ironic_python_agent import luks_utils
+from ironic_python_agent.tests.unit import base
+from ironic_python_agent import utils
+
+KEY = b'supersecret'
+
+
+@mock.patch.object(disk_utils, 'get_dev_sector_size', autospec=True,
+                   return_value=512)
+@mock.patch.object(utils, 'execute', autospec=True)
+class TestLuksUtils(base.IronicAgentTest):
+
+    def test_check_luks_compatibility(self, mock_execute, mock_sector_size):
+        mock_execute.return_value = ('cryptsetup 2.6.1', '')
+        self.assertTrue(luks_utils.check_luks_compatibility())
+        mock_execute.assert_called_once_with('cryptsetup', '--version')
+
+    def test_check_luks_compatibility_missing(self, mock_execute,
+                                              mock_sector_size):
+        mock_execute.side_effect = processutils.ProcessExecutionError('boom')
+        self.assertFalse(luks_utils.check_luks_compatibility())
+
+    def test_luks_format_partition(self, mock_execute, mock_sector_size):
+        luks_utils.luks_format_partition(KEY, '/dev/sda2')
+        mock_execute.assert_called_once_with(
+            'cryptsetup', 'luksFormat', '--type', 'luks2',
+            '--pbkdf', 'pbkdf2', '--pbkdf-force-iterations', '1000',
+            '--key-file', '-', '--batch-mode', '/dev/sda2',
+            process_input=KEY)
+
+    def test_luks_format_partition_failure(self, mock_execute,
+                                           mock_sector_size):
+        mock_execute.side_effect = processutils.ProcessExecutionError('boom')
+        self.assertRaises(processutils.ProcessExecutionError,
+                          luks_utils.luks_format_partition,
+                          KEY, '/dev/sda2')
+
+    def test_luks_format_partition_4k_device(self, mock_execute,
+                                             mock_sector_size):
+        mock_sector_size.return_value = 4096
+        luks_utils.luks_format_partition(KEY, '/dev/nvme0n1p2')
+        mock_execute.assert_called_once_with(
+            'cryptsetup', 'luksFormat', '--type', 'luks2',
+            '--sector-size', '4096',
+            '--pbkdf', 'pbkdf2', '--pbkdf-force-iterations', '1000',
+            '--key-file', '-', '--batch-mode', '/dev/nvme0n1p2',
+            process_input=KEY)
+
+    def test_luks_re_encrypt_partition(self, mock_execute, mock_sector_size):
+        luks_utils.luks_re_encrypt_partition(KEY, '/dev/sda2')
+        mock_execute.assert_called_once_with(
+            'cryptsetup', 'reencrypt', '--encrypt',
+            '--type', 'luks2', '--reduce-device-size', '32M',
+            '--resilience', 'checksum',
+            '--pbkdf', 'pbkdf2', '--pbkdf-force-iterations', '1000',
+            '--key-file', '-', '--batch-mode', '/dev/sda2',
+            process_input=KEY)
+
+    def test_luks_re_encrypt_partition_no_resilience(self, mock_execute,
+                                                     mock_sector_size):
+        luks_utils.luks_re_encrypt_partition(KEY, '/dev/sda2',
+                                             resilience='none')
+        mock_execute.assert_called_once_with(
+            'cryptsetup', 'reencrypt', '--encrypt',
+            '--type', 'luks2', '--reduce-device-size', '32M',
+            '--resilience', 'none',
+            '--pbkdf', 'pbkdf2', '--pbkdf-force-iterations', '1000',
+            '--key-file', '-', '--batch-mode', '/dev/sda2',
+            process_input=KEY)
+
+    @mock.patch.object(os.path, 'exists', autospec=True, return_value=False)
+    def test_luks_open_partition(self, mock_exists, mock_execute,
+                                 mock_sector_size):
+        result = luks_utils.luks_open_partition(KEY, '/dev/sda3', 'config-2')
+        self.assertEqual('/dev/mapper/config-2', result)
+        mock_execute.assert_called_once_with(
+            'cryptsetup', 'open', '--type', 'luks2',
+            '--key-file', '-', '/dev/sda3', 'config-2',
+            process_input=KEY)
+
+    @mock.patch.object(os.path, 'exists', autospec=True, return_value=True)
+    def test_luks_open_partition_already_open(self, mock_exists, mock_execute,
+                                              mock_sector_size):
+        result = luks_utils.luks_open_partition(KEY, '/dev/sda3', 'config-2')
+        self.assertEqual('/dev/mapper/config-2', result)
+        mock_execute.assert_not_called()
+        mock_exists.assert_called_once_with('/dev/mapper/config-2')
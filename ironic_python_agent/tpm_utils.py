@@ -0,0 +1,101 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Helpers around tpm2-tools for storing the LUKS key in the TPM."""
+
+import ctypes
+import os
+import sys
+
+from oslo_concurrency import processutils
+from oslo_log import log
+from oslo_utils import excutils
+
+from ironic_python_agent import utils
+
+LOG = log.getLogger()
+
+# TPM 2.0 NV index holding the sealed LUKS key.
+TPM_NV_INDEX = '0x1500016'
+# Size of the generated key in bytes.
+KEY_SIZE = 64
+# The in-kernel TPM 2.0 resource manager device.
+TPM_DEVICE = '/dev/tpmrm0'
+
+
+def check_tpm_compatibility():
+    """Check that a TPM 2.0 device and the tpm2 tools are usable.
+
+    :returns: True if the TPM can be used, False otherwise.
+    """
+    if not os.path.exists(TPM_DEVICE):
+        LOG.debug('No TPM 2.0 resource manager device found')
+        return False
+    try:
+        utils.execute('tpm2_getcap', 'properties-fixed')
+    except (processutils.ProcessExecutionError, OSError) as e:
+        LOG.debug('tpm2-tools are not usable: %s', e)
+        return False
+    return True
+
+
+def check_and_generate_key_file():
+    """Return the LUKS key, generating and sealing a new one if needed.
+
+    If a key is already sealed in the TPM it is unsealed, otherwise a
+    new random key is generated and sealed into the TPM NV index. The
+    plain text key only ever lives in memory and is handed to consumers
+    over a pipe, never through the file system.
+
+    :returns: the key as bytes.
+    :raises: ProcessExecutionError on failure to talk to the TPM.
+    """
+    try:
+        return unseal_tpm_key()
+    except processutils.ProcessExecutionError:
+        LOG.debug('No key sealed in the TPM yet, generating a new one')
+    key = os.urandom(KEY_SIZE)
+    try:
+        utils.execute('tpm2_nvdefine', '-s', str(KEY_SIZE), TPM_NV_INDEX)
+        utils.execute('tpm2_nvwrite', '-i', '-', TPM_NV_INDEX,
+                      process_input=key)
+    except processutils.ProcessExecutionError as e:
+        with excutils.save_and_reraise_exception():
+            LOG.error('Failed to seal the LUKS key into TPM NV index '
+                      '%(index)s: %(error)s',
+                      {'index': TPM_NV_INDEX, 'error': e})
+    return key
+
+
+def unseal_tpm_key():
+    """Unseal the LUKS key from the TPM.
+
+    :returns: the key as bytes.
+    :raises: ProcessExecutionError if no key is sealed in the TPM.
+    """
+    key, _e = utils.execute('tpm2_nvread', TPM_NV_INDEX, binary=True)
+    return key
+
+
+def zeroize_key(key):
+    """Best effort overwrite of key material in memory.
+
+    Shortens the window during which the unsealed key can be recovered
+    from agent memory. CPython specific: the bytes payload is located at
+    a fixed offset from the end of the object and overwritten in place.
+
+    :param key: the key bytes to wipe.
+    """
+    if not key:
+        return
+    offset = sys.getsizeof(key) - len(key) - 1
+    ctypes.memset(id(key) + offset, 0, len(key))